@@ -0,0 +1,65 @@
+""" Benchmark: birthdays engines, 'python' vs 'sql'
+
+Creates a temporary import with many citizens and dense relatives (families of `family_size`),
+times GET /imports/<id>/citizens/birthdays with every engine, and removes the import.
+
+    $ python bench_birthdays.py [citizens] [family_size]
+"""
+import sys
+import time
+import random
+
+from giftshop.app import create_app, db, models
+
+
+def create_import(n_citizens, family_size):
+    """ Create an import: families where everyone is a relative of everyone. Returns: import_id """
+    rnd = random.Random(0)
+    imp = models.Import()
+    db.session.add(imp)
+    db.session.flush()
+
+    rows = []
+    for citizen_id in range(1, n_citizens + 1):
+        family_start = (citizen_id - 1) // family_size * family_size + 1
+        family = range(family_start, min(family_start + family_size, n_citizens + 1))
+        rows.append(dict(
+            import_id=imp.import_id, citizen_id=citizen_id, version=1,
+            town='T', street='S', building='B', apartment=1, name='N', gender='male',
+            birth_date=f'{rnd.randint(1950, 2010)}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}',
+            _relatives=[relative_id for relative_id in family if relative_id != citizen_id],
+        ))
+    db.session.execute(models.Citizen.__table__.insert(), rows)
+    db.session.commit()
+
+    # As POST /imports does for large imports
+    db.session.execute('ANALYZE citizens')
+    db.session.commit()
+    return imp.import_id
+
+
+def delete_import(import_id):
+    """ Remove the import """
+    db.session.query(models.Citizen).filter(models.Citizen.import_id == import_id).delete()
+    db.session.query(models.Import).filter(models.Import.import_id == import_id).delete()
+    db.session.commit()
+
+
+if __name__ == '__main__':
+    n_citizens = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    family_size = int(sys.argv[2]) if len(sys.argv) > 2 else 11
+
+    app = create_app()
+    with app.app_context():
+        import_id = create_import(n_citizens, family_size)
+        try:
+            client = app.test_client()
+            results = {}
+            for engine in ('python', 'sql'):
+                app.config['BIRTHDAYS_ENGINE'] = engine
+                started = time.perf_counter()
+                results[engine] = client.get(f'/imports/{import_id}/citizens/birthdays').get_json()
+                print(f'{engine:>6}: {time.perf_counter() - started:.2f} s')
+            assert results['sql'] == results['python'], 'Engines disagree'
+        finally:
+            delete_import(import_id)
@@ -0,0 +1,36 @@
+""" Benchmark: cold boot time of the application
+
+Every run starts a fresh Python process that imports the application,
+the way a worker does when it boots.
+
+    $ python bench_startup.py [runs]
+"""
+import sys
+import time
+import subprocess
+from statistics import median
+
+
+def boot_time():
+    """ Time a cold boot of the application in a fresh process, seconds """
+    started = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import giftshop.app'], check=True)
+    return time.perf_counter() - started
+
+
+def python_time():
+    """ Time a bare Python process, seconds: the baseline to subtract """
+    started = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'], check=True)
+    return time.perf_counter() - started
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    python_times = [python_time() for _ in range(runs)]
+    boot_times = [boot_time() for _ in range(runs)]
+
+    print(f'python: median {median(python_times) * 1000:.0f} ms')
+    print(f'boot:   median {median(boot_times) * 1000:.0f} ms, min {min(boot_times) * 1000:.0f} ms')
+    print(f'app:    median {(median(boot_times) - median(python_times)) * 1000:.0f} ms')
@@ -0,0 +1,133 @@
+""" Admission control: concurrency limits and bounded queues per class of endpoints
+
+Heavy requests (imports, analytics) should not take all workers and DB connections:
+every class of endpoints gets a number of concurrent requests, and a bounded queue of waiting ones.
+When the queue is full, or waiting takes too long, the request fails with `503` and `Retry-After`.
+
+Configured with `ADMISSION_CONTROL`: {class name: {'concurrency': int, 'queue': int}}.
+Limits are per worker process.
+"""
+import threading
+from functools import wraps
+
+from flask import current_app
+
+from . import json
+
+
+class AdmissionRejected(Exception):
+    """ The request cannot be served now: try again later """
+
+
+class AdmissionController:
+    """ Limits concurrent requests of one class """
+    def __init__(self, name, concurrency, queue):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def acquire(self, timeout):
+        """ Wait for a slot, at most `timeout` seconds
+
+        Raises:
+            AdmissionRejected: the queue is full, or timed out
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self.queued >= self.queue:
+                    self.rejected += 1
+                    raise AdmissionRejected(f'Too many {self.name} requests')
+                self.queued += 1
+
+            acquired = self._slots.acquire(timeout=timeout)
+
+            with self._lock:
+                self.queued -= 1
+                if not acquired:
+                    self.rejected += 1
+                    raise AdmissionRejected(f'Too many {self.name} requests: timed out')
+
+        with self._lock:
+            self.active += 1
+            self.admitted += 1
+
+    def release(self):
+        """ Free the slot """
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
+
+
+def init_app(app):
+    """ Create admission controllers for the application """
+    app.extensions['admission'] = {
+        name: AdmissionController(name, limits['concurrency'], limits['queue'])
+        for name, limits in app.config['ADMISSION_CONTROL'].items()
+    }
+
+
+def get_controller(app, name):
+    """ Get the admission controller of a class of endpoints, or None when it is not limited """
+    return app.extensions['admission'].get(name)
+
+
+def admit(endpoint_class):
+    """ Decorator: limit concurrent requests of a view
+
+    Args:
+        endpoint_class: class name, or a function that returns it for the current request
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            name = endpoint_class() if callable(endpoint_class) else endpoint_class
+            controller = get_controller(current_app, name)
+            if controller is None:
+                return view(*args, **kwargs)
+
+            try:
+                controller.acquire(current_app.config['ADMISSION_QUEUE_TIMEOUT'])
+            except AdmissionRejected as e:
+                return json.json_error(e), 503, {'Retry-After': str(current_app.config['ADMISSION_RETRY_AFTER'])}
+
+            # The response is made here: encoding it to JSON is part of the work the slot limits
+            try:
+                response = current_app.make_response(view(*args, **kwargs))
+            except BaseException:
+                controller.release()
+                raise
+
+            # A streamed response keeps the slot until it is sent
+            if response.is_streamed:
+                response.call_on_close(controller.release)
+            else:
+                controller.release()
+            return response
+        return wrapper
+    return decorator
+
+
+def metrics(app):
+    """ Admission metrics in the Prometheus text format """
+    controllers = app.extensions['admission'].values()
+    lines = []
+    for metric, kind, description in (
+        ('active', 'gauge', 'Requests being served'),
+        ('queued', 'gauge', 'Requests waiting in the queue'),
+        ('admitted', 'counter', 'Requests admitted'),
+        ('rejected', 'counter', 'Requests rejected with 503'),
+    ):
+        name = f'giftshop_admission_{metric}' + ('_total' if kind == 'counter' else '')
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for controller in controllers:
+            lines.append(f'{name}{{class="{controller.name}"}} {getattr(controller, metric)}')
+    return '\n'.join(lines) + '\n'
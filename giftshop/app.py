@@ -1,48 +1,118 @@
 # Environment packages
 import time
-from datetime import date
+import random
+from functools import wraps
+from datetime import date, timedelta
+from sqlalchemy import exc as sa_db_exc, func, text
 from sqlalchemy.orm import exc as sa_exc
-from flask import Flask, request, jsonify
+from flask import Flask, Blueprint, Response, current_app, request, jsonify, stream_with_context
 from collections import Counter
-from numpy import array, percentile
 
 
 # Application packages
-from . import models, json
+from . import models, json, profiling, admission, export
 
-# Init Flask
-app = Flask(__name__)
-app.config.from_pyfile('app_config.py')
-app.json_encoder = json.JSONEncoder
-
-# Init Database
 db = models.db
-db.init_app(app)
 
 # Init views
+bp = Blueprint('giftshop', __name__)
+
+
+def create_app(config=None):
+    """ Create the application
+
+    Heavy dependencies (numpy) are imported by the views that use them,
+    and the DB engine is created on first use: creating the app is cheap.
+
+    Args:
+        config: dict of configuration values to override `app_config.py`
+    """
+    # Init Flask
+    app = Flask(__name__)
+    app.config.from_pyfile('app_config.py')
+    app.config.update(config or {})
+    app.json_encoder = json.JSONEncoder
+
+    # Init Database
+    db.init_app(app)
+
+    # Init views
+    app.register_blueprint(bp)
+
+    # Init profiling, admission control
+    profiling.init_app(app)
+    admission.init_app(app)
+    return app
+
+
+# ### Shards
+
+@bp.url_value_preprocessor
+def use_import_shard(endpoint, values):
+    """ Views of an import work with the shard it lives on """
+    if values and 'import_id' in values:
+        db.session().use_shard(models.shard_of(current_app, values['import_id']))
+
+
+# ### Read replicas
+
+# Cookie: until when the client reads from the primary, unix time
+PRIMARY_UNTIL_COOKIE = 'giftshop_primary_until'
+
+
+def read_replica(view):
+    """ Decorator: the view reads from a read replica
+
+    Unless the client has written recently: then it reads from the primary to see its own writes.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            primary_until = float(request.cookies.get(PRIMARY_UNTIL_COOKIE, 0))
+        except ValueError:
+            primary_until = 0
+        if primary_until < time.time():
+            db.session().use_read_replica()
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@bp.after_request
+def stick_to_primary_after_write(response):
+    """ After a successful write, make the client read from the primary for a while """
+    if current_app.config['SQLALCHEMY_READ_REPLICAS'] and request.method in ('POST', 'PATCH') and response.status_code < 400:
+        sticky_seconds = current_app.config['READ_REPLICAS_STICKY_SECONDS']
+        response.set_cookie(PRIMARY_UNTIL_COOKIE, str(time.time() + sticky_seconds), max_age=sticky_seconds)
+    return response
 
 
 # ### Views for testing
-@app.route('/')
+@bp.route('/')
 def api_index():
     return 'Hi!'
 
 
-@app.route('/reset')
+@bp.route('/reset')
 def api_reset_db():
     """ Reset the database: recreate all tables """
     models.reset_db()
     return 'Database is reset'
 
 
-@app.route('/sleep/<int:n>')
+@bp.route('/metrics')
+def api_metrics():
+    """ Metrics in the Prometheus text format """
+    return admission.metrics(current_app), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+@bp.route('/sleep/<int:n>')
 def api_sleep(n=10):
     """ A blocking view to test parallel requests """
     time.sleep(n)
     return f'Slept for {n} seconds'
 
 
-@app.route('/json')
+@bp.route('/json')
 def api_json():
     """ Example of a JSON endpoint """
     ssn = db.session
@@ -72,8 +142,15 @@ def api_json():
 
 
 # ### Views for import
-@app.route('/imports', methods=['POST'])
+@bp.route('/imports', methods=['POST'])
+@admission.admit('ingest')
 def api_imports():
+    """ Import citizens
+
+    With `IMPORTS_IDEMPOTENCY` enabled, a repeated import (same `Idempotency-Key` header, or same citizens)
+    returns the existing `import_id` without validating or saving anything.
+    An `Idempotency-Key` repeated with other citizens fails with `422`.
+    """
     ssn = db.session
 
     # Get data; fail on any error
@@ -82,6 +159,22 @@ def api_imports():
     except Exception as e:
         return json.json_error(e), 400
 
+    # Choose the shard. A repeated import goes to the same shard: to be found there
+    import_key = content_hash = None
+    if current_app.config['IMPORTS_IDEMPOTENCY']:
+        content_hash = json.content_hash(citizens)
+        import_key = _get_import_key(content_hash)
+        shard = models.shard_for_key(current_app, import_key)
+    else:
+        shard = random.randrange(models.shard_count(current_app))
+    ssn().use_shard(shard)
+
+    # Seen it already?
+    if import_key is not None:
+        found = _find_import_by_key(ssn, import_key)
+        if found is not None:
+            return _repeated_import(found, content_hash)
+
     # Prepare an import, create citizens
     # Validate citizen_id and relatives
     # 1) citizen_id should be unique in every import
@@ -91,6 +184,7 @@ def api_imports():
     citizen_ids = set()
     for citizen in citizens:
         try:
+            assert 'version' not in citizen, 'Cannot set version'
             current_id = int(citizen['citizen_id'])
             if current_id not in citizen_ids:
                 citizen_ids.add(current_id)
@@ -114,14 +208,77 @@ def api_imports():
         return json.json_error(ValueError), 400
 
     # Save
+    # Every import must get an id of its shard: otherwise, it would be looked up on another shard
+    models.check_shard_import_ids(current_app)
     ssn.add(imp)
-    ssn.commit()
+    if import_key is not None:
+        _purge_import_keys(ssn)
+        ssn.add(models.ImportKey(key=import_key, content_hash=content_hash, import_rel=imp))
+
+    try:
+        ssn.flush()
+        if models.shard_of(current_app, imp.import_id) != shard:
+            ssn.rollback()
+            raise RuntimeError(f'Shard {shard} has allocated import_id {imp.import_id} of another shard: see reset_db()')
+        ssn.commit()
+    except sa_db_exc.IntegrityError:
+        # A concurrent request has saved the same import first
+        ssn.rollback()
+        found = _find_import_by_key(ssn, import_key) if import_key is not None else None
+        if found is None:
+            raise
+        return _repeated_import(found, content_hash)
+
+    # A large import makes table statistics stale, and the planner would choose
+    # terrible plans for queries that join citizens (see `_BIRTHDAYS_SQL`)
+    if len(citizens) >= current_app.config['IMPORTS_ANALYZE_MIN_CITIZENS']:
+        ssn.execute('ANALYZE citizens')
+        ssn.commit()
 
     return {'data': {'import_id': imp.import_id}}, 201
 
 
-@app.route('/imports/<int:import_id>/citizens/<int:citizen_id>', methods=['PATCH'])
+def _get_import_key(content_hash):
+    """ Get the idempotency key of an import: the `Idempotency-Key` header, or the hash of the citizens """
+    key = request.headers.get('Idempotency-Key')
+    if key:
+        return f'key:{key}'
+    else:
+        return f'sha256:{content_hash}'
+
+
+def _find_import_by_key(ssn, import_key):
+    """ Find an import by its idempotency key, unless it has expired. Returns: (import_id, content_hash), or None """
+    return ssn.query(models.ImportKey.import_id, models.ImportKey.content_hash) \
+        .filter(models.ImportKey.key == import_key,
+                models.ImportKey.created_at > func.now() - timedelta(seconds=current_app.config['IMPORTS_IDEMPOTENCY_TTL'])) \
+        .one_or_none()
+
+
+def _repeated_import(found, content_hash):
+    """ Respond to a repeated import: with the existing import, unless its key was used for other citizens """
+    import_id, found_content_hash = found
+    if found_content_hash != content_hash:
+        return json.json_error(AssertionError('Idempotency-Key was used for other citizens')), 422
+    return {'data': {'import_id': import_id}}, 201
+
+
+def _purge_import_keys(ssn):
+    """ Forget expired idempotency keys """
+    ssn.query(models.ImportKey) \
+        .filter(models.ImportKey.created_at <= func.now() - timedelta(seconds=current_app.config['IMPORTS_IDEMPOTENCY_TTL'])) \
+        .delete(synchronize_session=False)
+
+
+@bp.route('/imports/<int:import_id>/citizens/<int:citizen_id>', methods=['PATCH'])
+@admission.admit('point')
 def api_patch_citizen(import_id, citizen_id):
+    """ Modify a citizen
+
+    Supports conditional writes: `If-Match: "<version>"` fails with `412` when the citizen has been modified.
+    The current version is returned in the `ETag` header.
+    Supports `?fields=a,b,c` to only return some of the fields.
+    """
     ssn = db.session
 
     # Get data; fail on any error
@@ -129,6 +286,8 @@ def api_patch_citizen(import_id, citizen_id):
         citizen_data = request.get_json()
         assert isinstance(citizen_data, dict) and len(citizen_data) != 0, 'No data sent'
         assert 'citizen_id' not in citizen_data, 'Cannot change citizen_id'
+        assert 'version' not in citizen_data, 'Cannot change version'
+        fields = _get_fields()
     except Exception as e:
         return json.json_error(e), 400
 
@@ -140,48 +299,199 @@ def api_patch_citizen(import_id, citizen_id):
     except sa_exc.NoResultFound as e:
         return json.json_error(e), 400
 
-    # Modify the citizen
-    for field_name, field_value in citizen_data.items():
-        try:
-            setattr(citizen, field_name, field_value)
-        # Validation errors
-        except AssertionError as e:
-            return json.json_error(e), 400
+    # Conditional write
+    if request.if_match and not request.if_match.contains(str(citizen.version)):
+        return json.json_error(AssertionError('Citizen has been modified')), 412
 
-    # Save
-    ssn.add(citizen)
-    ssn.commit()
+    # Modify the citizen, save
+    # A concurrent write in between makes the UPDATE fail: on commit,
+    # or on autoflush, when `relatives` queries other citizens
+    try:
+        for field_name, field_value in citizen_data.items():
+            try:
+                setattr(citizen, field_name, field_value)
+            # Validation errors
+            except AssertionError as e:
+                return json.json_error(e), 400
+
+        ssn.add(citizen)
+        ssn.commit()
+    except sa_exc.StaleDataError as e:
+        ssn.rollback()
+        return json.json_error(e), 412
 
     # Done
     return {
-        'data': citizen
-    }
+        'data': citizen.__json__(fields)
+    }, 200, {'ETag': f'"{citizen.version}"'}
+
+
+def _get_fields():
+    """ Get the list of fields requested with `?fields=a,b,c`, or `None` for the default fields """
+    fields = request.args.get('fields')
+    if fields is None:
+        return None
+
+    fields = [field for field in fields.split(',') if field]
+    unknown_fields = set(fields) - set(models.Citizen.json_fields + models.Citizen.json_extra_fields)
+    assert fields, 'No fields requested'
+    assert not unknown_fields, f'Unknown fields: {", ".join(sorted(unknown_fields))}'
+    return fields
 
 
 def _load_all_citizens(ssn, import_id):
     """ Load all citizens from an Import identified by `import_id` """
-    return ssn.query(models.Citizen) \
-        .filter(models.Citizen.import_id == import_id) \
-        .order_by(models.Citizen.citizen_id.asc()) \
-        .all()
+    return _query_citizens(ssn.query(models.Citizen), import_id).all()
+
+
+def _query_citizens(query, import_id, after_citizen_id=None, limit=None, town=None, gender=None):
+    """ Filter citizens of an Import identified by `import_id`, ordered by `citizen_id`
+
+    Keyset pagination: `after_citizen_id` and `limit` are served by the `(import_id, citizen_id)` unique index,
+    or by the `(import_id, [town,] [gender,] citizen_id)` index for the filters given,
+    so every page costs O(limit), no matter how far it is into the import.
+    """
+    query = query.filter(models.Citizen.import_id == import_id)
+    if town is not None:
+        query = query.filter(models.Citizen.town == town)
+    if gender is not None:
+        query = query.filter(models.Citizen.gender == gender)
+    if after_citizen_id is not None:
+        query = query.filter(models.Citizen.citizen_id > after_citizen_id)
+    query = query.order_by(models.Citizen.citizen_id.asc())
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def _get_page_args():
+    """ Get pagination and filter arguments: `?after_citizen_id=&limit=&town=&gender=` """
+    args = request.args
+    page = dict(
+        after_citizen_id=args.get('after_citizen_id', type=int),
+        limit=args.get('limit', type=int),
+        town=args.get('town'),
+        gender=args.get('gender'),
+    )
+
+    # `type=int` silently ignores invalid values
+    for name in ('after_citizen_id', 'limit'):
+        assert name not in args or page[name] is not None, f'Invalid {name}'
+    if page['limit'] is not None:
+        assert 0 < page['limit'] <= current_app.config['CITIZENS_PAGE_MAX_LIMIT'], 'Invalid limit'
+    if page['gender'] is not None:
+        assert page['gender'] in models.Gender.__members__, 'Invalid gender'
+    return page
+
+
+def _citizens_admission_class():
+    """ Admission class of GET /imports/<id>/citizens: a small page is cheap, anything else is heavy """
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit <= current_app.config['ADMISSION_POINT_MAX_LIMIT']:
+        return 'point'
+    return 'analytics'
 
 
-@app.route('/imports/<int:import_id>/citizens')
+@bp.route('/imports/<int:import_id>/citizens')
+@admission.admit(_citizens_admission_class)
+@read_replica
 def api_load_import(import_id):
+    """ Load citizens of an import
+
+    Supports `?fields=a,b,c` to only return some of the fields.
+    Supports keyset pagination with `?after_citizen_id=&limit=`, and filters: `?town=&gender=`.
+    When the page is full, `next_after_citizen_id` is given to fetch the next page.
+    """
     ssn = db.session
 
+    try:
+        fields = _get_fields()
+        page = _get_page_args()
+    except AssertionError as e:
+        return json.json_error(e), 400
+
     # Load citizens
-    citizens = _load_all_citizens(ssn, import_id)
+    if fields is None:
+        citizens = _query_citizens(ssn.query(models.Citizen), import_id, **page).all()
+        citizen_ids = [citizen.citizen_id for citizen in citizens]
+    else:
+        # Only load the requested columns, as dicts: no ORM objects are created.
+        # `citizen_id` is always loaded for the cursor
+        rows = _query_citizens(ssn.query(*models.Citizen.json_columns(fields), models.Citizen.citizen_id),
+                               import_id, **page).all()
+        citizens = [dict(zip(fields, row)) for row in rows]
+        citizen_ids = [row[-1] for row in rows]
 
     # Return
-    return {
+    ret = {
         'data': citizens
     }
+    if page['limit'] is not None and len(citizens) == page['limit']:
+        ret['next_after_citizen_id'] = citizen_ids[-1]
+    return ret
+
+
+@bp.route('/imports/<int:import_id>/citizens/export')
+@admission.admit('analytics')
+@read_replica
+def api_export_import(import_id):
+    """ Export all citizens of an import: `?format=csv|arrow|parquet`
+
+    Streams the file: citizens are read with a server-side cursor, in batches of `EXPORT_BATCH_SIZE`
+    """
+    ssn = db.session
+
+    try:
+        export_format = export.FORMATS[request.args.get('format', 'csv')]
+    except KeyError as e:
+        return json.json_error(e), 400
+
+    batches = _load_citizen_batches(ssn, import_id, current_app.config['EXPORT_BATCH_SIZE'])
+    try:
+        chunks = export_format.write(batches)
+    except ImportError as e:
+        return json.json_error(e), 501
+
+    return Response(stream_with_context(chunks), mimetype=export_format.mimetype, headers={
+        'Content-Disposition': f'attachment; filename=import-{import_id}.{export_format.extension}'
+    })
 
 
-@app.route('/imports/<int:import_id>/citizens/birthdays')
+def _load_citizen_batches(ssn, import_id, batch_size):
+    """ Load all citizens from an Import identified by `import_id`, in batches of rows in `export.COLUMNS` order
+
+    A server-side cursor is used: memory does not depend on the size of the import.
+    """
+    query = _query_citizens(ssn.query(*models.Citizen.json_columns(export.COLUMNS)), import_id)
+    result = ssn.connection().execution_options(stream_results=True).execute(query.statement)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        result.close()
+
+
+@bp.route('/imports/<int:import_id>/citizens/birthdays')
+@admission.admit('analytics')
+@read_replica
 def api_get_citizen_birthdays(import_id):
+    """ Count presents every citizen buys for relatives, by month
+
+    `BIRTHDAYS_ENGINE` chooses the implementation: 'sql' or 'python'
+    """
     ssn = db.session
+    get_birthdays = _BIRTHDAYS_ENGINES[current_app.config['BIRTHDAYS_ENGINE']]
+
+    return {
+        'data': get_birthdays(ssn, import_id)
+    }
+
+
+def _get_birthdays_python(ssn, import_id):
+    """ Birthdays: load all citizens, count in Python """
     citizens = {citizen.citizen_id: citizen
                 for citizen in _load_all_citizens(ssn, import_id)}
 
@@ -196,14 +506,47 @@ def api_get_citizen_birthdays(import_id):
                 }
             )
         months.clear()
+    return info
 
-    return {
-        'data': info
-    }
+
+# Birthdays: relatives are unnested, joined to citizens on the (import_id, citizen_id) unique index.
+# Only the counts leave the database
+_BIRTHDAYS_SQL = text("""
+    SELECT c.citizen_id, CAST(EXTRACT(MONTH FROM r.birth_date) AS INTEGER) AS month, COUNT(*) AS presents
+    FROM citizens c
+    CROSS JOIN LATERAL unnest(c._relatives) AS rel(citizen_id)
+    JOIN citizens r ON r.import_id = c.import_id AND r.citizen_id = rel.citizen_id
+    WHERE c.import_id = :import_id
+    GROUP BY c.citizen_id, month
+    ORDER BY c.citizen_id, month
+""")
 
 
-@app.route('/imports/<int:import_id>/towns/stat/percentile/age')
+def _get_birthdays_sql(ssn, import_id):
+    """ Birthdays: count in one PostgreSQL query """
+    info = {str(k): [] for k in range(1, 13)}
+    for citizen_id, month, presents in ssn.execute(_BIRTHDAYS_SQL, {'import_id': import_id}):
+        info[str(month)].append(
+            {
+                'citizen_id': citizen_id,
+                'presents': presents
+            }
+        )
+    return info
+
+
+_BIRTHDAYS_ENGINES = {
+    'python': _get_birthdays_python,
+    'sql': _get_birthdays_sql,
+}
+
+
+@bp.route('/imports/<int:import_id>/towns/stat/percentile/age')
+@admission.admit('analytics')
+@read_replica
 def api_get_age_statistics(import_id):
+    from numpy import array, percentile  # heavy; only needed here
+
     ssn = db.session
     citizens = _load_all_citizens(ssn, import_id)
 
@@ -226,3 +569,7 @@ def api_get_age_statistics(import_id):
     return {
         'data': data
     }
+
+
+# The application, for `flask run`
+app = create_app()
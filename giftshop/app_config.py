@@ -8,6 +8,48 @@ DEBUG = False
 # Custom configuration
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Max `?limit=` for GET /imports/<id>/citizens
+CITIZENS_PAGE_MAX_LIMIT = 10000
+
+# POST /imports: map repeated imports to the existing `import_id`,
+# by `Idempotency-Key` header, or by a hash of the citizens
+IMPORTS_IDEMPOTENCY = False
+# How long to remember imports, seconds
+IMPORTS_IDEMPOTENCY_TTL = 24 * 60 * 60
+
+# GET /imports/<id>/citizens/birthdays: 'sql' counts in PostgreSQL, 'python' loads all citizens and counts in Python
+BIRTHDAYS_ENGINE = 'sql'
+
+# POST /imports: update table statistics after imports this large
+IMPORTS_ANALYZE_MIN_CITIZENS = 10000
+
+# GET /imports/<id>/citizens/export: rows per batch: per CSV chunk, Arrow record batch, Parquet row group
+EXPORT_BATCH_SIZE = 10000
+
+# Admission control: concurrent requests and queue sizes per class of endpoints, per worker process.
+# See `giftshop/admission.py`
+ADMISSION_CONTROL = {
+    'ingest': {'concurrency': 2, 'queue': 8},  # POST /imports
+    'analytics': {'concurrency': 4, 'queue': 16},  # birthdays, percentiles, whole imports, exports
+    'point': {'concurrency': 32, 'queue': 64},  # PATCH, small pages of citizens
+}
+# Pages of citizens up to this `?limit=` are 'point' requests; larger ones are 'analytics'
+ADMISSION_POINT_MAX_LIMIT = 100
+# How long a request may wait in the queue, seconds
+ADMISSION_QUEUE_TIMEOUT = 10
+# `Retry-After` for rejected requests, seconds
+ADMISSION_RETRY_AFTER = 1
+
+# Profiling of live requests: see `giftshop/profiling.py`
+# Directory to write profiles to. None: disabled
+PROFILE_DIR = None
+# Profile requests with the `X-Profile: <PROFILE_TOKEN>` header. None: disabled
+PROFILE_TOKEN = None
+# Profile this fraction of all requests
+PROFILE_SAMPLE_RATE = 0.0
+# Stack sampling interval, seconds
+PROFILE_INTERVAL = 0.005
+
 # PostrgreSQL
 DB_USER = 'postgres'
 DB_PASSWORD = 'postgres'
@@ -16,6 +58,16 @@ DB_HOST = 'postgres'
 DB_PORT = 5433
 SQLALCHEMY_DATABASE_URI = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
 
+# Shards: list of database URIs of other shards. Imports are spread over shards, and
+# `SQLALCHEMY_DATABASE_URI` is the first shard. Cannot be changed without moving the data
+# Every shard allocates its own import ids: set up with `reset_db()`, checked before the first import
+SQLALCHEMY_SHARDS = []
+
+# Read replicas of the first shard: list of database URIs for GET views. Empty: use the primary
+SQLALCHEMY_READ_REPLICAS = []
+# After a write, a client reads from the primary for this long, seconds: to see its own writes
+READ_REPLICAS_STICKY_SECONDS = 5
+
 
 # For development
 #DB_USER = 'user'
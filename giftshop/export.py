@@ -0,0 +1,128 @@
+""" Bulk export of citizens: CSV, Arrow IPC stream, Parquet
+
+Every exporter takes batches of rows (tuples in `COLUMNS` order) and yields chunks of the file,
+so an import of any size is exported in constant memory.
+
+Arrow and Parquet require `pyarrow`: it is imported on first use.
+"""
+import io
+import csv
+
+
+# Columns, in order
+COLUMNS = ('citizen_id', 'town', 'street', 'building', 'apartment', 'name', 'birth_date', 'gender', 'relatives')
+
+
+class ExportFormat:
+    """ Export format: file extension, MIME type, and the function that writes it """
+    def __init__(self, extension, mimetype, write):
+        self.extension = extension
+        self.mimetype = mimetype
+        self.write = write
+
+
+def write_csv(batches):
+    """ CSV: dates in ISO format, relatives as a JSON list """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    # The header goes first: an empty import is a file with the header only
+    writer.writerow(COLUMNS)
+    yield _pop_text(buffer)
+
+    for rows in batches:
+        writer.writerows(
+            (citizen_id, town, street, building, apartment, name, birth_date.isoformat(), gender.name,
+             f'[{",".join(map(str, relatives))}]')
+            for citizen_id, town, street, building, apartment, name, birth_date, gender, relatives in rows
+        )
+        yield _pop_text(buffer)
+
+
+def _pop_text(buffer):
+    """ Get the text written to a StringIO, and empty it """
+    text = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return text
+
+
+def write_arrow(batches):
+    """ Arrow IPC stream: a record batch per batch """
+    import pyarrow.ipc  # heavy; only needed here
+    return _write_arrow_batches(batches, pyarrow.ipc.new_stream)
+
+
+def write_parquet(batches):
+    """ Parquet: a row group per batch """
+    import pyarrow.parquet  # heavy; only needed here
+    return _write_arrow_batches(batches, pyarrow.parquet.ParquetWriter)
+
+
+def _arrow_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ('citizen_id', pa.int32()),
+        ('town', pa.string()),
+        ('street', pa.string()),
+        ('building', pa.string()),
+        ('apartment', pa.int32()),
+        ('name', pa.string()),
+        ('birth_date', pa.date32()),
+        ('gender', pa.dictionary(pa.int8(), pa.string())),
+        ('relatives', pa.list_(pa.int32())),
+    ])
+
+
+def _write_arrow_batches(batches, new_writer):
+    """ Write batches with a pyarrow writer: `new_writer(sink, schema)` """
+    import pyarrow as pa
+
+    schema = _arrow_schema()
+    sink = _ChunkSink()
+    writer = new_writer(sink, schema)
+    for rows in batches:
+        columns = list(zip(*rows))
+        columns[COLUMNS.index('gender')] = [gender.name for gender in columns[COLUMNS.index('gender')]]
+        writer.write_batch(pa.record_batch(
+            [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+            schema=schema
+        ))
+        yield sink.pop()
+    writer.close()
+    yield sink.pop()
+
+
+class _ChunkSink:
+    """ File-like object for pyarrow writers: collects written bytes until they are popped """
+    def __init__(self):
+        self.closed = False
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def pop(self):
+        """ Get the bytes written since the last call """
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+FORMATS = {
+    'csv': ExportFormat('csv', 'text/csv', write_csv),
+    'arrow': ExportFormat('arrows', 'application/vnd.apache.arrow.stream', write_arrow),
+    'parquet': ExportFormat('parquet', 'application/vnd.apache.parquet', write_parquet),
+}
@@ -1,3 +1,5 @@
+import json
+import hashlib
 from logging import getLogger
 from enum import Enum
 from datetime import date
@@ -24,6 +26,12 @@ class JSONEncoder(flask.json.JSONEncoder):
             return super().default(v)
 
 
+def content_hash(v):
+    """ Get a hash of a JSON value that does not depend on key order or formatting """
+    canonical = json.dumps(v, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
 def json_error(e):
     # logger.exception(msg='JSON exception')
     return {'error': f'{type(e)}: {e}'}
@@ -1,14 +1,103 @@
 import enum
+import random
+import hashlib
 from datetime import date
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
 
-from sqlalchemy import Column, Integer, String, Date, Enum, ForeignKey, ARRAY, UniqueConstraint
-from sqlalchemy.orm import relationship, validates, object_session
+from sqlalchemy import Column, Integer, String, Date, DateTime, Enum, ForeignKey, ARRAY, UniqueConstraint, Index, MetaData, func
+from sqlalchemy.orm import relationship, validates, object_session, sessionmaker
 from sqlalchemy.ext.mutable import MutableList
 
 import re
 
-db = SQLAlchemy()
+
+class RoutingSession(SignallingSession):
+    """ Session that can send queries to a shard, or to a read replica
+
+    Shards: `SQLALCHEMY_DATABASE_URI` is the first shard, `SQLALCHEMY_SHARDS` is a list of database URIs of other shards.
+    Every import lives on one shard: see `shard_of()`. Call `use_shard()` before the first query.
+
+    Replicas of the first shard are configured with `SQLALCHEMY_READ_REPLICAS`, a list of database URIs.
+    Call `use_read_replica()` before the first query: one random replica serves the whole session.
+    Without replicas, everything goes to the primary.
+    """
+    _shard_engine = None
+    _replica_engine = None
+
+    def use_shard(self, shard):
+        """ Send further queries to a shard """
+        self._shard_engine = get_shard_engine(self.app, shard) if shard else None
+
+    def use_read_replica(self):
+        """ Send further queries to a read replica """
+        # Replicas only replicate the first shard
+        if self._shard_engine is not None:
+            return
+
+        bind_keys = replica_bind_keys(self.app)
+        if bind_keys:
+            self._replica_engine = get_state(self.app).db.get_engine(self.app, bind=random.choice(bind_keys))
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._replica_engine is not None:
+            return self._replica_engine
+        if self._shard_engine is not None:
+            return self._shard_engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ SQLAlchemy with shards and read replicas: see `RoutingSession` """
+    def init_app(self, app):
+        # Every shard and replica is a bind: engines are created and configured like any other
+        app.config.setdefault('SQLALCHEMY_SHARDS', [])
+        app.config.setdefault('SQLALCHEMY_READ_REPLICAS', [])
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds.update(zip(shard_bind_keys(app)[1:], app.config['SQLALCHEMY_SHARDS']))
+        binds.update(zip(replica_bind_keys(app), app.config['SQLALCHEMY_READ_REPLICAS']))
+        app.config['SQLALCHEMY_BINDS'] = binds or None
+
+        super().init_app(app)
+
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def replica_bind_keys(app):
+    """ Get bind keys of read replicas """
+    return [f'replica_{i}' for i in range(len(app.config['SQLALCHEMY_READ_REPLICAS']))]
+
+
+def shard_bind_keys(app):
+    """ Get bind keys of shards. The first shard is the default bind: None """
+    return [None] + [f'shard_{i}' for i in range(1, 1 + len(app.config['SQLALCHEMY_SHARDS']))]
+
+
+def get_shard_engine(app, shard):
+    """ Get the engine of a shard """
+    return get_state(app).db.get_engine(app, bind=shard_bind_keys(app)[shard])
+
+
+def shard_count(app):
+    """ Get the number of shards """
+    return 1 + len(app.config['SQLALCHEMY_SHARDS'])
+
+
+def shard_of(app, import_id):
+    """ Get the shard an import lives on
+
+    Shards allocate interleaving import ids: shard k allocates k+1, k+1+N, k+1+2N, ...
+    So the number of shards cannot change without moving the data.
+    """
+    return (import_id - 1) % shard_count(app)
+
+
+def shard_for_key(app, key):
+    """ Choose a shard for a new import by a key: the same key always gets the same shard """
+    return int(hashlib.sha256(key.encode()).hexdigest(), 16) % shard_count(app)
+
+
+db = RoutingSQLAlchemy()
 
 
 class Gender(enum.Enum):
@@ -34,6 +123,10 @@ class Citizen(db.Model):
     __table_args__ = (
         # Every citizen_id is unique within an import
         UniqueConstraint('import_id', 'citizen_id'),
+        # Pages of citizens with filters: GET /imports/<id>/citizens?town=&gender=
+        Index('ix_citizens_import_id_town_citizen_id', 'import_id', 'town', 'citizen_id'),
+        Index('ix_citizens_import_id_gender_citizen_id', 'import_id', 'gender', 'citizen_id'),
+        Index('ix_citizens_import_id_town_gender_citizen_id', 'import_id', 'town', 'gender', 'citizen_id'),
     )
 
     id = Column(Integer, primary_key=True, doc="Уникальный номер человека в нашей системе")
@@ -54,24 +147,38 @@ class Citizen(db.Model):
     _relatives = Column(MutableList.as_mutable(ARRAY(Integer)), nullable=False, default=list,  # list of ids
                        doc="Ближайшие родственники, уникальные значения существующих citizen_id жителей из этой же выгрузки.")
 
+    # Optimistic concurrency: SQLAlchemy increments it with every UPDATE,
+    # and an UPDATE of a stale object fails with `StaleDataError`
+    version = Column(Integer, nullable=False, doc="Версия записи (для If-Match)")
+
+    __mapper_args__ = {
+        'version_id_col': version,
+    }
+
+    # Fields in JSON, in the default order
+    json_fields = ('citizen_id', 'town', 'street', 'building', 'apartment', 'name', 'birth_date', 'gender', 'relatives')
+    # Fields that are only given when requested explicitly
+    json_extra_fields = ('version',)
+
     def __init__(self, relatives=(), **fields):
         """ Init method that supports `relatives` """
         super().__init__(**fields)
         self._relatives = relatives
 
-    def __json__(self):
-        """ Representation in JSON """
-        return {
-            'citizen_id': self.citizen_id,
-            'town': self.town,
-            'street': self.street,
-            'building': self.building,
-            'apartment': self.apartment,
-            'name': self.name,
-            'birth_date': self.birth_date,
-            'gender': self.gender,
-            'relatives': self.relatives,
-        }
+    def __json__(self, fields=None):
+        """ Representation in JSON
+
+        Args:
+            fields: the list of fields to include. Default: `json_fields`
+        """
+        return {field: getattr(self, field)
+                for field in fields or self.json_fields}
+
+    @classmethod
+    def json_columns(cls, fields):
+        """ Get columns to SELECT in order to get `fields` in JSON, labeled with field names """
+        return [getattr(cls, '_relatives' if field == 'relatives' else field).label(field)
+                for field in fields]
 
     def get_age(self, today: date.today()):
         """ Get age in years """
@@ -190,14 +297,79 @@ class Citizen(db.Model):
         return values
 
 
+class ImportKey(db.Model):
+    """ Ключ идемпотентности выгрузки: повторная выгрузка с тем же ключом возвращает ту же выгрузку """
+    __tablename__ = 'import_keys'
+
+    key = Column(String, primary_key=True, doc="Idempotency-Key, или хэш содержимого выгрузки")
+    content_hash = Column(String, nullable=False, doc="Хэш содержимого выгрузки")
+    import_id = Column(Integer, ForeignKey(Import.import_id), nullable=False, doc="Номер выгрузки")
+    import_rel = relationship(Import)
+    created_at = Column(DateTime, nullable=False, server_default=func.now(), index=True, doc="Время создания")
+
+
 def reset_db():
-    """ Reset the database: recreate all tables """
-    db.reflect()
-    db.drop_all()
-    db.create_all()
+    """ Reset the database: recreate all tables, on every shard """
+    app = db.get_app()
+    for shard in range(shard_count(app)):
+        engine = get_shard_engine(app, shard)
+
+        # Drop everything there is
+        existing = MetaData()
+        existing.reflect(bind=engine)
+        existing.drop_all(bind=engine)
+
+        db.Model.metadata.create_all(bind=engine)
+        _init_shard_import_ids(engine, shard, shard_count(app))
     return 'Database is reset'
 
 
+def truncate_db():
+    """ Remove all data, keep the tables: one statement per shard, much faster than `reset_db()` """
+    app = db.get_app()
+    for shard in range(shard_count(app)):
+        engine = get_shard_engine(app, shard)
+        quote = engine.dialect.identifier_preparer.quote
+        tables = ', '.join(quote(table.name) for table in db.metadata.sorted_tables)
+        with engine.begin() as connection:
+            connection.execute(f'TRUNCATE TABLE {tables} RESTART IDENTITY CASCADE')
+
+
+def _init_shard_import_ids(engine, shard, shard_count):
+    """ Make a shard allocate its own import ids: see `shard_of()` """
+    with engine.begin() as connection:
+        sequence = _get_import_id_sequence(connection)
+        connection.execute(f'ALTER SEQUENCE {sequence} INCREMENT BY {shard_count} START WITH {shard + 1} RESTART')
+
+
+def check_shard_import_ids(app):
+    """ Make sure every shard allocates its own import ids, as `reset_db()` sets up: see `shard_of()`
+
+    Checked once per application. A single shard allocates any ids: nothing to check.
+
+    Raises:
+        RuntimeError: a shard allocates import ids of other shards
+    """
+    if shard_count(app) == 1 or app.extensions.get('shard_import_ids_checked'):
+        return
+
+    for shard in range(shard_count(app)):
+        with get_shard_engine(app, shard).connect() as connection:
+            sequence = _get_import_id_sequence(connection)
+            increment, start = connection.execute(
+                'SELECT seqincrement, seqstart FROM pg_sequence WHERE seqrelid = CAST(%s AS regclass)', sequence).first()
+        if (increment, start) != (shard_count(app), shard + 1):
+            raise RuntimeError(f'Shard {shard} allocates import ids from {start} by {increment}, '
+                               f'expected from {shard + 1} by {shard_count(app)}: see reset_db()')
+    app.extensions['shard_import_ids_checked'] = True
+
+
+def _get_import_id_sequence(connection):
+    """ Get the name of the sequence that allocates import ids """
+    table_name = connection.dialect.identifier_preparer.quote(Import.__table__.name)
+    return connection.execute(f"SELECT pg_get_serial_sequence('{table_name}', 'import_id')").scalar()
+
+
 nonempty_alphanumeric_str = re.compile('[\w\d]')
 
 
@@ -0,0 +1,149 @@
+""" On-demand profiling of live requests
+
+A request is profiled when `PROFILE_DIR` is set, and:
+* it has the `X-Profile: <PROFILE_TOKEN>` header, or
+* it is sampled: `PROFILE_SAMPLE_RATE` of all requests.
+
+The profile is written to `PROFILE_DIR`:
+* `<name>.folded`: sampled stacks in the collapsed format: for `flamegraph.pl` or speedscope
+* `<name>.sql.txt`: SQL statements with timings
+
+Disabled, it costs one config lookup per request.
+SQL listeners are registered once, when the application is created with `PROFILE_DIR`:
+registering them while requests are running is not safe.
+"""
+import os
+import sys
+import hmac
+import time
+import random
+import threading
+from collections import Counter
+
+from flask import current_app, request, g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROFILE_HEADER = 'X-Profile'
+
+# The profiler of the current thread
+_active = threading.local()
+
+# SQL listeners are registered
+_listening = False
+
+
+class RequestProfiler:
+    """ Stack-sampling profiler for one thread, plus SQL statements it executes """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.stacks = Counter()
+        self.statements = []  # (duration, statement)
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        """ Start profiling the current thread """
+        _active.profiler = self
+        self._sampler.start()
+        return self
+
+    def stop(self):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._sampler.join()
+        if getattr(_active, 'profiler', None) is self:
+            _active.profiler = None
+
+    def write(self, directory, name):
+        """ Write the profile to `directory`. Returns: the path, without extension """
+        path = os.path.join(directory, name)
+        with open(f'{path}.folded', 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{";".join(stack)} {count}\n')
+        with open(f'{path}.sql.txt', 'w') as f:
+            for duration, statement in self.statements:
+                f.write(f'{duration * 1000:.2f} ms\t{" ".join(statement.split())}\n')
+        return path
+
+    def _sample(self):
+        """ Sampler thread: record the stack of the profiled thread """
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_active, 'profiler', None) is not None:
+        conn.info.setdefault('profiler_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('profiler_started')
+    if started:
+        duration = time.perf_counter() - started.pop()
+        profiler = getattr(_active, 'profiler', None)
+        if profiler is not None:
+            profiler.statements.append((duration, statement))
+
+
+def _handle_error(exception_context):
+    # A failed statement: `after_cursor_execute` did not run
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('profiler_started'):
+        conn.info['profiler_started'].pop()
+
+
+def init_app(app):
+    """ Profile requests of the application, when enabled """
+    global _listening
+    if app.config['PROFILE_DIR'] and not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+        _listening = True
+
+    app.before_request(_start_profiling)
+    app.after_request(_write_profile)
+    app.teardown_request(_stop_profiling)
+
+
+def _should_profile():
+    config = current_app.config
+    if not config['PROFILE_DIR']:
+        return False
+
+    token = request.headers.get(PROFILE_HEADER)
+    if token and config['PROFILE_TOKEN'] and hmac.compare_digest(token.encode(), config['PROFILE_TOKEN'].encode()):
+        return True
+    return random.random() < config['PROFILE_SAMPLE_RATE']
+
+
+def _start_profiling():
+    if _should_profile():
+        g.profiler = RequestProfiler(current_app.config['PROFILE_INTERVAL']).start()
+
+
+def _write_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
+        name = f'{int(time.time() * 1000)}-{request.endpoint}-{os.getpid()}-{profiler.thread_id}'
+        path = profiler.write(current_app.config['PROFILE_DIR'], name)
+        response.headers[PROFILE_HEADER] = os.path.basename(path)
+    return response
+
+
+def _stop_profiling(exc):
+    # A failed request: after_request handlers did not run
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
@@ -1,16 +1,33 @@
+import io
+import os
+import csv
+import time
+import random
 import unittest
+from unittest import mock
+import importlib.util
+import tempfile
+import threading
 from contextlib import contextmanager
 from datetime import datetime, date
 
-from giftshop.app import app, db, models
+from giftshop.app import app, db, models, create_app
+from giftshop import profiling, admission, export
+from sqlalchemy import exc as sa_exc, event
 
 
 class MyTestCase(unittest.TestCase):
-    def setUp(self):
-        # Reset the DB with every test
+    @classmethod
+    def setUpClass(cls):
+        # Recreate the tables once
         with app.app_context():
             models.reset_db()
 
+    def setUp(self):
+        # Clean the DB with every test
+        with app.app_context():
+            models.truncate_db()
+
         ctx = app.app_context().__enter__()
         self.addCleanup(ctx.__exit__, None, None, None)
 
@@ -241,6 +258,7 @@ class MyTestCase(unittest.TestCase):
         test_invalid_citizen(birth_date='NOT-DATE-FORMAT')  # bad date format
         test_invalid_citizen(birth_date='31.02.2019')  # bad date
         test_invalid_citizen(relatives=['a', 'b', 'c'])  # bad relatives list
+        test_invalid_citizen(version=5)  # managed by the server
 
         # Test: many citizens
         citizens = self.sample_citizens
@@ -257,6 +275,47 @@ class MyTestCase(unittest.TestCase):
             rv = c.post('/imports', json=input_json).get_json()
             self.assertEqual(rv['data']['import_id'], 3)
 
+    def test_api_imports_idempotency(self):
+        """ Test: repeated POST /imports with IMPORTS_IDEMPOTENCY """
+        ssn = db.session
+        app.config['IMPORTS_IDEMPOTENCY'] = True
+        self.addCleanup(app.config.update, IMPORTS_IDEMPOTENCY=False, IMPORTS_IDEMPOTENCY_TTL=24 * 60 * 60)
+
+        with self.client() as c:
+            # Same citizens: same import
+            rv = c.post('/imports', json={'citizens': self.sample_citizens})
+            self.assertEqual(rv.get_json(), {'data': {'import_id': 1}})
+            rv = c.post('/imports', json={'citizens': self.sample_citizens})
+            self.assertEqual(rv.status_code, 201)
+            self.assertEqual(rv.get_json(), {'data': {'import_id': 1}})
+            self.assertEqual(ssn.query(models.Citizen).count(), len(self.sample_citizens))
+
+            # Key order does not matter
+            reordered_citizens = [dict(reversed(list(citizen.items()))) for citizen in self.sample_citizens]
+            rv = c.post('/imports', json={'citizens': reordered_citizens})
+            self.assertEqual(rv.get_json(), {'data': {'import_id': 1}})
+
+            # Different citizens: new import
+            rv = c.post('/imports', json=self.sample_TASK_PDF)
+            self.assertEqual(rv.get_json(), {'data': {'import_id': 2}})
+
+            # Idempotency-Key
+            rv = c.post('/imports', json={'citizens': [self.sample_citizen]}, headers={'Idempotency-Key': 'abc'})
+            self.assertEqual(rv.get_json(), {'data': {'import_id': 3}})
+            rv = c.post('/imports', json={'citizens': [self.sample_citizen]}, headers={'Idempotency-Key': 'abc'})
+            self.assertEqual(rv.get_json(), {'data': {'import_id': 3}})
+
+            # Idempotency-Key with other citizens
+            rv = c.post('/imports', json={'citizens': self.sample_citizens}, headers={'Idempotency-Key': 'abc'})
+            self.assertEqual(rv.status_code, 422)
+            self.assertIn('error', rv.get_json())
+
+            # Expired
+            app.config['IMPORTS_IDEMPOTENCY_TTL'] = 0
+            rv = c.post('/imports', json={'citizens': self.sample_citizens})
+            self.assertEqual(rv.get_json(), {'data': {'import_id': 4}})
+            self.assertEqual(ssn.query(models.ImportKey).count(), 1)  # expired keys are purged
+
     def test_api_patch_citizen(self):
         """ Test: PATCH /imports/$import_id/citizens/$citizen_id """
         with self.client() as c:
@@ -288,6 +347,51 @@ class MyTestCase(unittest.TestCase):
             self.assertEqual(self.getCitizen(import_id, 3).relatives, [])  # 1 removed
             self.assertEqual(self.getCitizen(import_id, 5).relatives, [1])  # 1 added
 
+    def test_api_patch_citizen_if_match(self):
+        """ Test: PATCH /imports/$import_id/citizens/$citizen_id with If-Match and ?fields= """
+        with self.client() as c:
+            # Create citizens
+            rv = c.post('/imports', json={'citizens': self.sample_citizens}).get_json()
+            import_id = rv['data']['import_id']
+
+            # Patch citizen: get the version
+            rv = c.patch(f'/imports/{import_id}/citizens/1', json=dict(name='Z'))
+            self.assertEqual(rv.status_code, 200)
+            etag = rv.headers['ETag']
+            self.assertEqual(etag, '"2"')
+
+            # Patch citizen: matching version
+            rv = c.patch(f'/imports/{import_id}/citizens/1', json=dict(name='Y'), headers={'If-Match': etag})
+            self.assertEqual(rv.status_code, 200)
+
+            # Patch citizen: stale version
+            rv = c.patch(f'/imports/{import_id}/citizens/1', json=dict(name='X'), headers={'If-Match': etag})
+            self.assertEqual(rv.status_code, 412)
+            self.assertEqual(self.getCitizen(import_id, 1).name, 'Y')  # not changed
+
+            # Patch citizen: a concurrent write after the citizen is loaded.
+            # `name` is flushed when `relatives` queries other citizens
+            def concurrent_write(*args):
+                db.engine.execute(f'UPDATE citizens SET name = \'V\', version = version + 1 '
+                                  f'WHERE import_id = {import_id} AND citizen_id = 1')
+            event.listen(models.Citizen, 'load', concurrent_write, once=True)
+            rv = c.patch(f'/imports/{import_id}/citizens/1', json=dict(name='X', relatives=[2, 3, 4]))
+            self.assertEqual(rv.status_code, 412)
+            self.assertEqual(self.getCitizen(import_id, 1).name, 'V')  # not changed
+            self.assertEqual(self.getCitizen(import_id, 4).relatives, [])  # not changed
+
+            # Patch citizen: projection
+            rv = c.patch(f'/imports/{import_id}/citizens/1?fields=name,version', json=dict(name='W')).get_json()
+            self.assertEqual(rv['data'], {'name': 'W', 'version': 5})
+
+            # Patch citizen: unknown fields
+            rv = c.patch(f'/imports/{import_id}/citizens/1?fields=UNKNOWN', json=dict(name='V'))
+            self.assertEqual(rv.status_code, 400)
+
+            # Patch citizen: cannot change the version
+            rv = c.patch(f'/imports/{import_id}/citizens/1', json=dict(version=10))
+            self.assertEqual(rv.status_code, 400)
+
     def test_api_get_import_citizens(self):
         """ Test: GET /imports/$import_id/citizens """
         with self.client() as c:
@@ -302,6 +406,124 @@ class MyTestCase(unittest.TestCase):
             self.assertEqual(rv['data'][0], self.sample_citizens[0])
             self.assertEqual(rv['data'], self.sample_citizens)
 
+            # Load citizens: projection
+            rv = c.get(f'/imports/{import_id}/citizens?fields=citizen_id,birth_date,relatives').get_json()
+            self.assertEqual(rv['data'], [
+                {'citizen_id': citizen['citizen_id'],
+                 'birth_date': citizen['birth_date'],
+                 'relatives': citizen['relatives']}
+                for citizen in self.sample_citizens
+            ])
+
+            # Load citizens: unknown fields
+            rv = c.get(f'/imports/{import_id}/citizens?fields=citizen_id,UNKNOWN')
+            self.assertEqual(rv.status_code, 400)
+
+    def test_api_get_import_citizens_pages(self):
+        """ Test: GET /imports/$import_id/citizens?after_citizen_id=&limit=&town=&gender= """
+        citizens = [
+            {**self.sample_citizen, 'citizen_id': 1, 'town': 'M', 'gender': 'male'},
+            {**self.sample_citizen, 'citizen_id': 2, 'town': 'P', 'gender': 'female'},
+            {**self.sample_citizen, 'citizen_id': 3, 'town': 'M', 'gender': 'female'},
+            {**self.sample_citizen, 'citizen_id': 4, 'town': 'M', 'gender': 'male'},
+            {**self.sample_citizen, 'citizen_id': 5, 'town': 'P', 'gender': 'male'},
+        ]
+
+        with self.client() as c:
+            # Create citizens
+            rv = c.post('/imports', json={'citizens': citizens}).get_json()
+            import_id = rv['data']['import_id']
+
+            # Load pages
+            rv = c.get(f'/imports/{import_id}/citizens?limit=2').get_json()
+            self.assertEqual(rv, {'data': citizens[0:2], 'next_after_citizen_id': 2})
+            rv = c.get(f'/imports/{import_id}/citizens?limit=2&after_citizen_id=2').get_json()
+            self.assertEqual(rv, {'data': citizens[2:4], 'next_after_citizen_id': 4})
+            rv = c.get(f'/imports/{import_id}/citizens?limit=2&after_citizen_id=4').get_json()
+            self.assertEqual(rv, {'data': citizens[4:]})  # last page
+
+            # Filters
+            rv = c.get(f'/imports/{import_id}/citizens?town=M&gender=male').get_json()
+            self.assertEqual(rv, {'data': [citizens[0], citizens[3]]})
+
+            # Filters + pages + projection
+            rv = c.get(f'/imports/{import_id}/citizens?town=M&limit=1&after_citizen_id=1&fields=name').get_json()
+            self.assertEqual(rv, {'data': [{'name': 'N'}], 'next_after_citizen_id': 3})
+
+            # Invalid arguments
+            for query in ('limit=0', 'limit=a', 'after_citizen_id=a', 'gender=UNKNOWN'):
+                rv = c.get(f'/imports/{import_id}/citizens?{query}')
+                self.assertEqual(rv.status_code, 400, query)
+
+    def test_api_export_import(self):
+        """ Test: GET /imports/$import_id/citizens/export?format=csv """
+        self.addCleanup(app.config.update, EXPORT_BATCH_SIZE=app.config['EXPORT_BATCH_SIZE'])
+        app.config['EXPORT_BATCH_SIZE'] = 2  # several batches
+
+        with self.client() as c:
+            # Create citizens
+            rv = c.post('/imports', json={'citizens': self.sample_citizens}).get_json()
+            import_id = rv['data']['import_id']
+
+            # Export
+            # The response is streamed: closing it frees the admission slot
+            with c.get(f'/imports/{import_id}/citizens/export?format=csv') as rv:
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.mimetype, 'text/csv')
+                rows = list(csv.DictReader(io.StringIO(rv.get_data(as_text=True))))
+            self.assertEqual(len(rows), len(self.sample_citizens))
+            self.assertEqual(rows[0], {
+                'citizen_id': '1', 'town': 'M', 'street': 'S', 'building': 'B', 'apartment': '1', 'name': 'A',
+                'birth_date': '1986-12-26', 'gender': 'male', 'relatives': '[2,3]',
+            })
+
+            # Unknown format
+            rv = c.get(f'/imports/{import_id}/citizens/export?format=UNKNOWN')
+            self.assertEqual(rv.status_code, 400)
+
+            # No citizens: the header only
+            with c.get('/imports/999/citizens/export?format=csv') as rv:
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(list(csv.reader(io.StringIO(rv.get_data(as_text=True)))), [list(export.COLUMNS)])
+
+            # Every admission slot is freed
+            self.assertEqual(admission.get_controller(app, 'analytics').active, 0)
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_api_export_import_arrow(self):
+        """ Test: GET /imports/$import_id/citizens/export?format=arrow|parquet """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.addCleanup(app.config.update, EXPORT_BATCH_SIZE=app.config['EXPORT_BATCH_SIZE'])
+        app.config['EXPORT_BATCH_SIZE'] = 2  # several batches
+
+        expected = [
+            {**citizen, 'birth_date': date(1986, 12, 26)}
+            for citizen in self.sample_citizens
+        ]
+
+        with self.client() as c:
+            # Create citizens
+            rv = c.post('/imports', json={'citizens': self.sample_citizens}).get_json()
+            import_id = rv['data']['import_id']
+
+            # Arrow
+            with c.get(f'/imports/{import_id}/citizens/export?format=arrow') as rv:
+                table = pa.ipc.open_stream(rv.get_data()).read_all()
+            self.assertEqual(table.schema.field('birth_date').type, pa.date32())
+            self.assertEqual(table.schema.field('relatives').type, pa.list_(pa.int32()))
+            self.assertEqual(table.to_pylist(), expected)
+
+            # Parquet
+            with c.get(f'/imports/{import_id}/citizens/export?format=parquet') as rv:
+                parquet_file = pq.ParquetFile(pa.BufferReader(rv.get_data()))
+            self.assertEqual(parquet_file.num_row_groups, 3)
+            self.assertEqual(parquet_file.read().to_pylist(), expected)
+
+            # Every admission slot is freed
+            self.assertEqual(admission.get_controller(app, 'analytics').active, 0)
+
     def test_api_get_citizen_birthdays(self):
         """ Test: /imports/<int:import_id>/citizens/birthdays """
         with self.client() as c:
@@ -342,6 +564,37 @@ class MyTestCase(unittest.TestCase):
                         }
                     ]}})
 
+    def test_api_get_citizen_birthdays_engines(self):
+        """ Test: /imports/<int:import_id>/citizens/birthdays: 'sql' and 'python' engines give the same result """
+        # Citizens with random birth dates and many relatives
+        rnd = random.Random(0)
+        relatives = {citizen_id: set() for citizen_id in range(1, 51)}
+        for _ in range(200):
+            a, b = rnd.sample(list(relatives), 2)
+            relatives[a].add(b)
+            relatives[b].add(a)
+        citizens = [
+            {**self.sample_citizen, 'citizen_id': citizen_id,
+             'birth_date': f'{rnd.randint(1, 28):02d}.{rnd.randint(1, 12):02d}.{rnd.randint(1950, 2010)}',
+             'relatives': sorted(citizen_relatives)}
+            for citizen_id, citizen_relatives in relatives.items()
+        ]
+
+        self.addCleanup(app.config.update, BIRTHDAYS_ENGINE=app.config['BIRTHDAYS_ENGINE'])
+        with self.client() as c:
+            # Create citizens
+            rv = c.post('/imports', json={'citizens': citizens}).get_json()
+            import_id = rv['data']['import_id']
+
+            # Compare
+            results = {}
+            for engine in ('python', 'sql'):
+                app.config['BIRTHDAYS_ENGINE'] = engine
+                results[engine] = c.get(f'/imports/{import_id}/citizens/birthdays').get_json()
+            self.assertEqual(results['sql'], results['python'])
+            self.assertEqual(sum(present['presents'] for month in results['sql']['data'].values() for present in month),
+                             sum(len(citizen['relatives']) for citizen in citizens))
+
     def test_api_get_age_statistics(self):
         """ Test: /imports/<int:import_id>/towns/stat/percentile/age """
         with self.client() as c:
@@ -368,6 +621,225 @@ class MyTestCase(unittest.TestCase):
                 ]
             })
 
+    @unittest.skipUnless(os.environ.get('TEST_REPLICA_DATABASE_URI'),
+                         'Set TEST_REPLICA_DATABASE_URI to another PostgreSQL database to test read replicas')
+    def test_read_replicas(self):
+        """ Test: GET views read from a replica, unless the client has written recently """
+        replica_app = create_app({'SQLALCHEMY_READ_REPLICAS': [os.environ['TEST_REPLICA_DATABASE_URI']]})
+        replica_app.testing = True
+
+        with replica_app.app_context():
+            # An empty replica: it does not replicate anything in tests
+            replica_engine = db.get_engine(replica_app, bind='replica_0')
+            db.Model.metadata.create_all(bind=replica_engine)
+            replica_engine.execute('TRUNCATE TABLE citizens RESTART IDENTITY CASCADE')
+
+            # Write, then read: from the primary
+            c = replica_app.test_client()
+            rv = c.post('/imports', json={'citizens': self.sample_citizens}).get_json()
+            import_id = rv['data']['import_id']
+            rv = c.get(f'/imports/{import_id}/citizens').get_json()
+            self.assertEqual(rv['data'], self.sample_citizens)
+
+            # Another client: reads from the replica
+            c = replica_app.test_client()
+            rv = c.get(f'/imports/{import_id}/citizens').get_json()
+            self.assertEqual(rv['data'], [])
+
+    @unittest.skipUnless(os.environ.get('TEST_SHARD_DATABASE_URIS'),
+                         'Set TEST_SHARD_DATABASE_URIS to other PostgreSQL databases, comma-separated, to test shards')
+    def test_shards(self):
+        """ Test: imports are spread over shards, and are served by their shard """
+        shard_uris = os.environ['TEST_SHARD_DATABASE_URIS'].split(',')
+        sharded_app = create_app({'SQLALCHEMY_SHARDS': shard_uris})
+        sharded_app.testing = True
+        n_shards = 1 + len(shard_uris)
+
+        with sharded_app.app_context():
+            models.reset_db()
+            self.addCleanup(models.reset_db)  # other tests expect ids from 1, one by one
+
+            # Imports: distinct names to tell them apart
+            c = sharded_app.test_client()
+            import_ids = {}
+            for n in range(10 * n_shards):
+                citizens = [{**citizen, 'name': f'{citizen["name"]}{n}'} for citizen in self.sample_citizens]
+                rv = c.post('/imports', json={'citizens': citizens})
+                self.assertEqual(rv.status_code, 201)
+                import_ids[rv.get_json()['data']['import_id']] = citizens
+
+            # Every import lives on its shard
+            for shard in range(n_shards):
+                engine = models.get_shard_engine(sharded_app, shard)
+                shard_import_ids = {import_id for import_id, in engine.execute('SELECT import_id FROM "import"')}
+                self.assertEqual(shard_import_ids,
+                                 {import_id for import_id in import_ids if models.shard_of(sharded_app, import_id) == shard})
+            self.assertEqual(len(import_ids), 10 * n_shards)
+
+            # Every import is served by its shard
+            for import_id, citizens in import_ids.items():
+                rv = c.get(f'/imports/{import_id}/citizens').get_json()
+                self.assertEqual(rv['data'], citizens)
+
+                rv = c.patch(f'/imports/{import_id}/citizens/1', json={'name': 'Z'})
+                self.assertEqual(rv.get_json()['data']['name'], 'Z')
+
+            # Shards that allocate import ids of other shards: imports fail
+            for shard in range(n_shards):
+                engine = models.get_shard_engine(sharded_app, shard)
+                sequence = engine.execute("SELECT pg_get_serial_sequence('import', 'import_id')").scalar()
+                engine.execute(f'ALTER SEQUENCE {sequence} START WITH {(shard + 1) % n_shards + 1} RESTART')
+            misconfigured_app = create_app({'SQLALCHEMY_SHARDS': shard_uris})
+            misconfigured_app.testing = True
+            c = misconfigured_app.test_client()
+            with self.assertRaisesRegex(RuntimeError, 'Shard 0 allocates import ids from 2 by 3'):
+                c.post('/imports', json={'citizens': self.sample_citizens})
+
+            # ... even when the check of shards is skipped: nothing is saved
+            with mock.patch.object(models, 'check_shard_import_ids'):
+                with self.assertRaisesRegex(RuntimeError, 'has allocated import_id'):
+                    c.post('/imports', json={'citizens': self.sample_citizens})
+            for shard in range(n_shards):
+                count = models.get_shard_engine(sharded_app, shard).execute('SELECT COUNT(*) FROM "import"').scalar()
+                self.assertEqual(count, len([import_id for import_id in import_ids
+                                             if models.shard_of(sharded_app, import_id) == shard]))
+            models.reset_db()
+
+    def test_profiling(self):
+        """ Test: requests with the `X-Profile` header are profiled """
+        profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(profile_dir.cleanup)
+        profiled_app = create_app({'PROFILE_DIR': profile_dir.name, 'PROFILE_TOKEN': 'secret', 'PROFILE_INTERVAL': 0.001})
+        profiled_app.testing = True
+
+        with profiled_app.app_context():
+            c = profiled_app.test_client()
+
+            # Not profiled: no header, wrong token
+            rv = c.post('/imports', json={'citizens': self.sample_citizens})
+            self.assertNotIn('X-Profile', rv.headers)
+            rv = c.get('/imports/1/citizens', headers={'X-Profile': 'wrong'})
+            self.assertNotIn('X-Profile', rv.headers)
+            self.assertEqual(os.listdir(profile_dir.name), [])
+
+            # Profiled
+            rv = c.get('/imports/1/citizens/birthdays', headers={'X-Profile': 'secret'})
+            self.assertEqual(rv.status_code, 200)
+            path = os.path.join(profile_dir.name, rv.headers['X-Profile'])
+            with open(f'{path}.sql.txt') as f:
+                self.assertIn('FROM citizens', f.read())
+            self.assertTrue(os.path.exists(f'{path}.folded'))
+
+            # A failed statement leaves nothing behind on the connection
+            connection = db.session.connection()
+            profiler = profiling.RequestProfiler().start()
+            with self.assertRaises(sa_exc.ProgrammingError):
+                connection.execute('SELECT * FROM no_such_table')
+            profiler.stop()
+            self.assertEqual(connection.info.get('profiler_started'), [])
+            db.session.rollback()
+
+    def test_request_profiler(self):
+        """ Test: RequestProfiler samples stacks """
+        def busy_function():
+            started = time.perf_counter()
+            while time.perf_counter() - started < 0.1:
+                pass
+
+        profiler = profiling.RequestProfiler(interval=0.001).start()
+        busy_function()
+        profiler.stop()
+
+        self.assertTrue(any('busy_function (test.py' in stack[-1] for stack in profiler.stacks))
+
+    def test_admission_control(self):
+        """ Test: requests over the limit fail with 503 and Retry-After """
+        limited_app = create_app({
+            'ADMISSION_CONTROL': {'ingest': {'concurrency': 1, 'queue': 0}, 'point': {'concurrency': 1, 'queue': 0}},
+            'ADMISSION_POINT_MAX_LIMIT': 10,
+            'ADMISSION_RETRY_AFTER': 3,
+        })
+        limited_app.testing = True
+        ingest = admission.get_controller(limited_app, 'ingest')
+
+        with limited_app.app_context():
+            c = limited_app.test_client()
+
+            # Busy: rejected
+            ingest.acquire(timeout=0)
+            rv = c.post('/imports', json={'citizens': self.sample_citizens})
+            self.assertEqual(rv.status_code, 503)
+            self.assertEqual(rv.headers['Retry-After'], '3')
+
+            # Other classes are not limited
+            rv = c.get('/imports/1/citizens/birthdays')
+            self.assertEqual(rv.status_code, 200)
+
+            # Small pages are 'point' requests, large pages are 'analytics'
+            point = admission.get_controller(limited_app, 'point')
+            point.acquire(timeout=0)
+            rv = c.get('/imports/1/citizens?limit=10')
+            self.assertEqual(rv.status_code, 503)
+            rv = c.get('/imports/1/citizens?limit=11')
+            self.assertEqual(rv.status_code, 200)
+            point.release()
+
+            # Free: admitted
+            ingest.release()
+            rv = c.post('/imports', json={'citizens': self.sample_citizens})
+            self.assertEqual(rv.status_code, 201)
+
+            # Metrics
+            rv = c.get('/metrics')
+            self.assertIn('giftshop_admission_rejected_total{class="ingest"} 1', rv.get_data(as_text=True))
+            self.assertIn('giftshop_admission_rejected_total{class="point"} 1', rv.get_data(as_text=True))
+            self.assertIn('giftshop_admission_admitted_total{class="ingest"} 2', rv.get_data(as_text=True))
+
+    def test_admission_control_encoding(self):
+        """ Test: the slot is held while the response is encoded to JSON """
+        analytics = admission.get_controller(app, 'analytics')
+        encode = models.Citizen.__json__
+        active_while_encoding = []
+
+        def spy(citizen, *args, **kwargs):
+            active_while_encoding.append(analytics.active)
+            return encode(citizen, *args, **kwargs)
+
+        with self.client() as c:
+            rv = c.post('/imports', json={'citizens': self.sample_citizens}).get_json()
+            import_id = rv['data']['import_id']
+
+            with mock.patch.object(models.Citizen, '__json__', spy):
+                rv = c.get(f'/imports/{import_id}/citizens')
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(active_while_encoding, [1] * len(self.sample_citizens))
+            self.assertEqual(analytics.active, 0)
+
+    def test_admission_controller_queue(self):
+        """ Test: AdmissionController queues requests up to the limit """
+        controller = admission.AdmissionController('test', concurrency=1, queue=1)
+        controller.acquire(timeout=0)
+
+        # Queued: waits for the slot
+        waiter = threading.Thread(target=controller.acquire, kwargs=dict(timeout=10))
+        waiter.start()
+        while controller.queued != 1:
+            time.sleep(0.001)
+
+        # The queue is full
+        with self.assertRaises(admission.AdmissionRejected):
+            controller.acquire(timeout=10)
+
+        # Slot is freed: the queued request gets it
+        controller.release()
+        waiter.join()
+        self.assertEqual((controller.active, controller.queued, controller.admitted, controller.rejected), (1, 0, 2, 1))
+
+        # Timeout
+        with self.assertRaises(admission.AdmissionRejected):
+            controller.acquire(timeout=0.01)
+        self.assertEqual(controller.rejected, 2)
+
     @contextmanager
     def client(self):
         """ Get a client for testing the Flask application """